@@ -1,37 +1,40 @@
 import streamlit as st
-from rembg import remove
-from PIL import Image, UnidentifiedImageError
-import tempfile
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import onnxruntime as ort
+from rembg.sessions.u2net import U2netSession
+from PIL import ExifTags, Image, ImageOps, UnidentifiedImageError
+import io
 import os
+import shutil
+import tempfile
+import multiprocessing
+from typing import Optional
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from multiprocessing.pool import Pool
+from matting import GPU_PROVIDER, create_session, init_worker, matte, matte_in_worker
 
 # Constants
 MAX_IMAGE_SIZE_MB = 5  # Maximum allowed file size in MB
 MAX_IMAGE_DIMENSION = 1024  # Maximum dimension for compression
+PNG_COMPRESS_LEVEL = 1  # Fast zlib level; output is only slightly larger than the default of 6
+SPOOL_CHUNK_SIZE = 1 << 20  # Copy uploads to disk in 1MB chunks
 ALLOWED_IMAGE_FORMATS = ["png", "jpg", "jpeg", "bmp", "tiff"]  # Supported image formats
+CACHE_MAX_ENTRIES = 32  # Cached images per function (~4MB each), shared by all sessions
+CACHE_TTL_SECONDS = 3600  # Drop cached images after an hour
+BATCH_WORKERS = max(1, (os.cpu_count() or 2) // 2)  # rembg worker processes for batch uploads
+POOL_STARTUP_TIMEOUT_SECONDS = 300  # Time for workers to load (and possibly download) the model
+BATCH_TASK_TIMEOUT_SECONDS = 120  # Time allowed to matte one batch image
 
 # Get the directory of the current script
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-# Set Streamlit configuration
-st.set_page_config(page_title="Image Processor", layout="centered")
-
-# Load custom CSS if available
-css_path = os.path.join(BASE_DIR, "style.css")
-if os.path.exists(css_path):
-    with open(css_path, "r") as f:
-        st.markdown(f"<style>{f.read()}</style>", unsafe_allow_html=True)
-
-# Title and description
-st.markdown("""
-<div class="container">
-    <h1>Image Background Replacement Tool</h1>
-    <p>Upload a foreground and background image to create a composite image.</p>
-</div>
-""", unsafe_allow_html=True)
-
-# File upload widgets
-foreground_file = st.file_uploader("Upload Foreground Image", type=ALLOWED_IMAGE_FORMATS)
-background_file = st.file_uploader("Upload Background Image", type=ALLOWED_IMAGE_FORMATS)
+@st.cache_resource(show_spinner=False)
+def load_css(path: str) -> str:
+    """Read a stylesheet once and wrap it in a <style> tag; empty if the file is missing."""
+    if not os.path.exists(path):
+        return ""
+    with open(path, "r") as f:
+        return f"<style>{f.read()}</style>"
 
 def validate_file(file, file_type):
     """ Validate file format and size """
@@ -50,81 +53,232 @@ def validate_file(file, file_type):
         return True
     return False
 
+def fast_resize(image: Image.Image, size: tuple[int, int]) -> Image.Image:
+    """Resize with a box filter when shrinking by 2x or more, otherwise with Lanczos."""
+    src_width, src_height = image.size
+    dst_width, dst_height = size
+    if src_width >= 2 * dst_width and src_height >= 2 * dst_height:
+        return image.resize(size, Image.Resampling.BOX)
+    return image.resize(size, Image.Resampling.LANCZOS)
+
+def spool_upload(uploaded_file) -> str:
+    """Copy an uploaded file to a temporary file on disk and return its path."""
+    suffix = os.path.splitext(uploaded_file.name)[1]
+    uploaded_file.seek(0)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as spooled:
+        shutil.copyfileobj(uploaded_file, spooled, length=SPOOL_CHUNK_SIZE)
+    return spooled.name
+
 def compress_image(image: Image.Image, max_dimension: int) -> Image.Image:
     """Resize the image while maintaining aspect ratio if necessary."""
     if max(image.size) > max_dimension:
+        if image.mode in ("1", "P"):
+            # Bilevel and palette images can't be box-averaged
+            image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+            return image
+
+        scale = max_dimension / max(image.size)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        # Let JPEG decode at a reduced scale, as Image.thumbnail() does
+        image.draft(None, (size[0] * 2, size[1] * 2))
+
+        # Box-reduce by src // (2 * dst) so Lanczos runs on a smaller intermediate; the
+        # factor only exceeds 1 from a 4x downscale, leaving Lanczos at least 2x to filter
+        factor = max(image.size) // (2 * max_dimension)
+        if factor > 1:
+            image = image.reduce(factor)
         image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
     return image
 
-# Validate both files
-valid_foreground = validate_file(foreground_file, "Foreground")
-valid_background = validate_file(background_file, "Background")
+def load_image(uploaded_file) -> tuple[tuple[int, int], Image.Image]:
+    """Spool, decode and compress an upload; returns its original size and the loaded image."""
+    path = spool_upload(uploaded_file)
+    try:
+        image = Image.open(path)
+        # Apply EXIF orientation up front so the matting paths and batch workers see the same pixels;
+        # unrotated images stay lazy so JPEG draft decoding still applies
+        if image.getexif().get(ExifTags.Base.Orientation, 1) != 1:
+            image = ImageOps.exif_transpose(image)
+        original_size = image.size
+        image = compress_image(image, MAX_IMAGE_DIMENSION)
+        image.load()
+        return original_size, image
+    finally:
+        os.unlink(path)
 
-# Process the images when both are valid
-if valid_foreground and valid_background:
-    with st.spinner("⏳ Processing images..."):
-        try:
-            # Load images
-            foreground_img = Image.open(foreground_file)
-            background_img = Image.open(background_file)
+def encode_png(image: Image.Image) -> bytes:
+    """Encode an image as PNG in memory, favouring speed over file size."""
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", compress_level=PNG_COMPRESS_LEVEL, optimize=False)
+    return buffer.getvalue()
 
-            # Log original image sizes
-            st.write(f"📏 Original Foreground Size: {foreground_img.size}")
-            st.write(f"📏 Original Background Size: {background_img.size}")
+@st.cache_resource(show_spinner=False)
+def get_rembg_session(use_gpu: bool) -> U2netSession:
+    """Load the background removal model once per provider set and reuse it across reruns."""
+    return create_session(use_gpu)
 
-            # Compress images if necessary
-            foreground_img = compress_image(foreground_img, MAX_IMAGE_DIMENSION)
-            background_img = compress_image(background_img, MAX_IMAGE_DIMENSION)
+@st.cache_resource(show_spinner=False)
+def get_worker_pool(use_gpu: bool) -> Pool:
+    """Start the batch worker processes once; each loads its own ONNX session."""
+    # Spawn rather than fork so workers don't inherit the app's ONNX Runtime thread pools
+    context = multiprocessing.get_context("spawn")
+    threads_per_worker = max(1, (os.cpu_count() or 1) // BATCH_WORKERS)
+    pool = context.Pool(BATCH_WORKERS, initializer=init_worker, initargs=(use_gpu, threads_per_worker))
 
-            # Log compressed image sizes
-            st.write(f"📏 Compressed Foreground Size: {foreground_img.size}")
-            st.write(f"📏 Compressed Background Size: {background_img.size}")
+    # A failing initializer makes Pool respawn workers forever, so wait for one to come up
+    try:
+        pool.apply_async(os.getpid).get(timeout=POOL_STARTUP_TIMEOUT_SECONDS)
+    except multiprocessing.TimeoutError:
+        pool.terminate()
+        raise RuntimeError("Batch workers failed to start; check that the model can be loaded.")
+    return pool
 
-            # Create a temporary directory for processing
-            with tempfile.TemporaryDirectory() as temp_dir:
-                foreground_path = os.path.join(temp_dir, 'foreground.png')
-                processed_foreground_path = os.path.join(temp_dir, 'processed_foreground.png')
+def matte_in_pool(pool: Pool, image: Image.Image, alpha_matting: bool, use_gpu: bool) -> Image.Image:
+    """Matte one image in the worker pool, restarting the pool if the task times out."""
+    try:
+        return pool.apply_async(matte_in_worker, (image, alpha_matting)).get(timeout=BATCH_TASK_TIMEOUT_SECONDS)
+    except multiprocessing.TimeoutError:
+        get_worker_pool.clear(use_gpu)
+        pool.terminate()
+        raise RuntimeError("A batch worker timed out; the worker pool has been restarted.")
 
-                # Save foreground temporarily
-                foreground_img.save(foreground_path)
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+def matte_foreground(foreground_bytes: bytes, alpha_matting: bool, use_gpu: bool, _foreground_img: Image.Image, _pool: Optional[Pool] = None) -> Image.Image:
+    """Remove the background from the foreground, memoized by upload content and settings."""
+    if _pool is not None:
+        return matte_in_pool(_pool, _foreground_img, alpha_matting, use_gpu)
+    return matte(_foreground_img, get_rembg_session(use_gpu), alpha_matting)
 
-                # Process foreground to remove background
-                with open(foreground_path, 'rb') as input_file, open(processed_foreground_path, 'wb') as output_file:
-                    output_file.write(remove(input_file.read(), alpha_matting=True))
+def matte_batch(foreground_files: list, images: list[Image.Image], alpha_matting: bool, use_gpu: bool) -> list[Image.Image]:
+    """Remove the background from several foregrounds, sending only cache misses to the worker pool."""
+    # Start (or fail to start) the pool once, before any work is queued
+    pool = get_worker_pool(use_gpu)
 
-                # Load the processed foreground image
-                processed_foreground = Image.open(processed_foreground_path)
+    # One thread per worker process keeps at most BATCH_WORKERS tasks in flight, so each task's
+    # timeout only covers its own run; the threads share the script context for st.cache_data
+    ctx = get_script_run_ctx()
+    executor = ThreadPoolExecutor(max_workers=BATCH_WORKERS, initializer=add_script_run_ctx, initargs=(None, ctx))
+    try:
+        futures = [
+            executor.submit(matte_foreground, f.getvalue(), alpha_matting, use_gpu, image, pool)
+            for f, image in zip(foreground_files, images)
+        ]
+        wait(futures, return_when=FIRST_EXCEPTION)
+        for future in futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        return [future.result() for future in futures]
+    finally:
+        # On failure, drop queued images and don't wait for the ones still in flight
+        executor.shutdown(wait=False, cancel_futures=True)
 
-                # Resize background if dimensions don't match
-                if processed_foreground.size != background_img.size:
-                    background_img = background_img.resize(processed_foreground.size)
+@st.cache_data(show_spinner=False, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL_SECONDS)
+def prepare_background(background_bytes: bytes, size: tuple[int, int], _background_img: Image.Image) -> Image.Image:
+    """Resize the background to `size` as RGBA, memoized by upload content and target size."""
+    if _background_img.size != size:
+        _background_img = fast_resize(_background_img, size)
+    if _background_img.mode != "RGBA":
+        _background_img = _background_img.convert("RGBA")
+    return _background_img
 
-                # Ensure both images are in RGBA mode
-                processed_foreground = processed_foreground.convert("RGBA")
-                background_img = background_img.convert("RGBA")
+def main():
+    """Render the Streamlit app."""
+    # Set Streamlit configuration
+    st.set_page_config(page_title="Image Processor", layout="centered")
 
-                # Composite the images
-                output_img = Image.alpha_composite(background_img, processed_foreground)
+    # Load custom CSS if available
+    css_html = load_css(os.path.join(BASE_DIR, "style.css"))
+    if css_html:
+        st.markdown(css_html, unsafe_allow_html=True)
 
-                # Display the result
-                st.image(output_img, caption="🎨 Final Output Image", use_container_width=True)
-                st.success("✅ Image processing completed successfully!")
+    # Title and description
+    st.markdown("""
+<div class="container">
+    <h1>Image Background Replacement Tool</h1>
+    <p>Upload one or more foreground images and a background image to create composite images.</p>
+</div>
+""", unsafe_allow_html=True)
+
+    # Processing settings
+    gpu_available = GPU_PROVIDER in ort.get_available_providers()
+    use_gpu = st.sidebar.toggle(
+        "Use GPU (CUDA)",
+        value=gpu_available,
+        disabled=not gpu_available,
+        help="Requires onnxruntime-gpu and a CUDA-capable device."
+    )
+    use_matting = st.sidebar.checkbox(
+        "High-quality edges (slower)",
+        value=False,
+        help="Refine the cutout edges with alpha matting."
+    )
+
+    # File upload widgets
+    foreground_files = st.file_uploader("Upload Foreground Image(s)", type=ALLOWED_IMAGE_FORMATS, accept_multiple_files=True)
+    background_file = st.file_uploader("Upload Background Image", type=ALLOWED_IMAGE_FORMATS)
+
+    # Validate all files
+    valid_foreground = bool(foreground_files) and all([validate_file(f, "Foreground") for f in foreground_files])
+    valid_background = validate_file(background_file, "Background")
+
+    # Process the images when all are valid
+    if valid_foreground and valid_background:
+        with st.spinner("⏳ Processing images..."):
+            try:
+                # Load and compress all images concurrently; Pillow releases the GIL while decoding
+                with ThreadPoolExecutor(max_workers=min(len(foreground_files) + 1, os.cpu_count() or 1)) as executor:
+                    foreground_futures = [executor.submit(load_image, f) for f in foreground_files]
+                    background_future = executor.submit(load_image, background_file)
+                    foregrounds = [future.result() for future in foreground_futures]
+                    background_size, background_img = background_future.result()
+
+                # Log original and compressed image sizes
+                for foreground_file, (foreground_size, foreground_img) in zip(foreground_files, foregrounds):
+                    st.write(f"📏 Original Foreground Size ({foreground_file.name}): {foreground_size}")
+                    st.write(f"📏 Compressed Foreground Size ({foreground_file.name}): {foreground_img.size}")
+                st.write(f"📏 Original Background Size: {background_size}")
+                st.write(f"📏 Compressed Background Size: {background_img.size}")
 
-                # Save output image for download
-                output_img_path = os.path.join(temp_dir, "output.png")
-                output_img.save(output_img_path)
+                # Remove foreground backgrounds; batches are spread across worker processes
+                if len(foregrounds) == 1:
+                    processed_foregrounds = [matte_foreground(foreground_files[0].getvalue(), use_matting, use_gpu, foregrounds[0][1])]
+                else:
+                    processed_foregrounds = matte_batch(foreground_files, [img for _, img in foregrounds], use_matting, use_gpu)
 
-                # Provide download button
-                with open(output_img_path, "rb") as img_file:
+                background_bytes = background_file.getvalue()
+                for index, (foreground_file, processed_foreground) in enumerate(zip(foreground_files, processed_foregrounds)):
+                    if processed_foreground.mode != "RGBA":
+                        processed_foreground = processed_foreground.convert("RGBA")
+
+                    # Resize background to the foreground dimensions in RGBA mode
+                    background_rgba = prepare_background(background_bytes, processed_foreground.size, background_img)
+
+                    # Composite the images
+                    output_img = Image.alpha_composite(background_rgba, processed_foreground)
+
+                    # Encode once; the same PNG bytes are displayed and downloaded
+                    output_png = encode_png(output_img)
+                    output_name = "output.png" if len(foreground_files) == 1 else f"output_{index + 1}.png"
+
+                    # Display the result
+                    st.image(output_png, caption=f"🎨 Final Output Image ({foreground_file.name})", use_container_width=True)
+
+                    # Provide download button
                     st.download_button(
-                        label="⬇️ Download Output Image",
-                        data=img_file,
-                        file_name="output.png",
-                        mime="image/png"
+                        label=f"⬇️ Download {output_name}",
+                        data=output_png,
+                        file_name=output_name,
+                        mime="image/png",
+                        key=f"download_{index}"
                     )
-        except UnidentifiedImageError:
-            st.error("❌ One of the uploaded files is not a valid image. Please try again.")
-        except Exception as e:
-            st.error(f"❌ An unexpected error occurred: {e}")
-else:
-    st.info("📢 Please upload both foreground and background images to proceed.")
+                st.success("✅ Image processing completed successfully!")
+            except UnidentifiedImageError:
+                st.error("❌ One of the uploaded files is not a valid image. Please try again.")
+            except Exception as e:
+                st.error(f"❌ An unexpected error occurred: {e}")
+    else:
+        st.info("📢 Please upload at least one foreground image and a background image to proceed.")
+
+# Streamlit runs the script as __main__; spawned batch workers import it as __mp_main__
+if __name__ == "__main__":
+    main()